@@ -19,8 +19,9 @@
 # along with this program. If not, see <http://www.gnu.org/licenses/>.
 #=========================================================================
 
-import sys, argparse, re, inspect, os, math
-from decimal import Decimal
+import sys, argparse, re, os, math, hashlib, pickle, tempfile
+
+intern = sys.intern
 
 VERSION = "1.0-6"
 
@@ -33,6 +34,17 @@ T_TAG = 3
 T_FUNC = 4
 T_CONST = 5
 
+# shared tokens for synthesized expressions
+TOK_LPAREN = (T_OPER, "(")
+TOK_RPAREN = (T_OPER, ")")
+TOK_PLUS = (T_OPER, "+")
+TOK_MINUS = (T_OPER, "-")
+TOK_MUL = (T_OPER, "*")
+TOK_DIV = (T_OPER, "/")
+TOK_COMMA = (T_OPER, ",")
+TOK_ONE = (T_NUM, 1)
+TOK_FLOOR = (T_ID, "floor")
+
 # external consts
 CONSTANTS = {
   "pi":math.pi,
@@ -96,6 +108,12 @@ LIBRARY = [
   ("__!=", ("l", "r"), [(T_OPER, "("), (T_NUM, 4), (T_OPER, "-"), (T_OPER, "("), (T_NUM, 1), (T_OPER, "+"), (T_ID, "sign"), (T_OPER, "("), (T_ID, "l"), (T_OPER, "-"), (T_ID, "r"), (T_OPER, ")"), (T_OPER, ")"), (T_OPER, "*"), (T_OPER, "("), (T_NUM, 1), (T_OPER, "-"), (T_ID, "signn"), (T_OPER, "("), (T_ID, "l"), (T_OPER, "-"), (T_ID, "r"), (T_OPER, ")"), (T_OPER, ")"), (T_OPER, ")"), (T_OPER, "/"), (T_NUM, 4)])
 ]
 
+# intern the extern and library names so functions-table lookups against
+# interned lexed identifiers compare by identity (the __* spellings are
+# not identifier-like, so the compiler does not intern them on its own)
+EXTERNS = [(intern(name), parms) for name, parms in EXTERNS]
+LIBRARY = [(intern(name), parms, expr) for name, parms, expr in LIBRARY]
+
 # globals
 cmdline = None
 src = {}
@@ -117,21 +135,21 @@ def error(message, line_no=None, col_no=None, filename=None, ti_offset=0):
     else:
       token_type, value, line_no, col_no, filename = tokens[ti]
   if line_no is not None:
-    line = src[filename][line_no - 1].rstrip("\r\n")
-    posinfo = "In file `{0}': Line {1}, Col {2}, `{3}':\n".format(filename, line_no, col_no, line)
+    line = src[filename][line_no - 1]
+    posinfo = f"In file `{filename}': Line {line_no}, Col {col_no}, `{line}':\n"
   else:
     posinfo = ""
-  sys.exit("{0}{1}.".format(posinfo, message))
+  sys.exit(f"{posinfo}{message}.")
 
 def debug_print(var, value=None):
   if cmdline.debug:
     if value is None:
-      sys.stderr.write("[{0}] {1}\n".format(fn, var))
+      sys.stderr.write(f"[{fn}] {var}\n")
     else:
-      if type(value).__name__ == "str":
-        sys.stderr.write("[{0}] {1} = `{2}'\n".format(fn, var, value))
+      if isinstance(value, str):
+        sys.stderr.write(f"[{fn}] {var} = `{value}'\n")
       else:
-        sys.stderr.write("[{0}] {1} = {2}\n".format(fn, var, value))
+        sys.stderr.write(f"[{fn}] {var} = {value}\n")
 
 def debug_parse(d):
   if not cmdline.debug:
@@ -150,7 +168,8 @@ def debug_parse(d):
   else:
     token = None
     line = None
-  sys.stderr.write("{0} ({1}): ti={2}, token={3}, fn={4}, line=`{5}'\n".format(inspect.stack()[2][3], d, ti, token, fn, line))
+  caller = sys._getframe(2).f_code.co_name
+  sys.stderr.write(f"{caller} ({d}): ti={ti}, token={token}, fn={fn}, line=`{line}'\n")
 
 def debug_in():
   debug_parse("in")
@@ -158,13 +177,27 @@ def debug_in():
 def debug_out():
   debug_parse("out")
 
-WHITESPACE = " \t\r\n\f\v"
-OPERATORS = ("(", ")", "!=", "!", "^", "*", "/", "%", "+", "-", "<=", "<:", "<>", "<", ">=", ">:", ">", "&&", "||", "==", "=", "?", ":", ",", ";", "{", "}")
-RE_NUM = re.compile(r"\d*\.?\d+")
-RE_ID = re.compile("[A-Za-z_][0-9A-Za-z_]*")
-RE_TAG = re.compile(r"#[0-9A-Za-z_]*#")
+WHITESPACE_CHARS = " \t\r\n\f\v"
+WHITESPACE = frozenset(WHITESPACE_CHARS)
+# interned so lexed operator tokens compare by identity against these
+OPERATORS = tuple(intern(op) for op in ("(", ")", "!=", "!", "^", "*", "/", "%", "+", "-", "<=", "<:", "<>", "<", ">=", ">:", ">", "&&", "||", "==", "=", "?", ":", ",", ";", "{", "}"))
 INCLUDE_KEYWORDS = ("include", "#include", "import")
 
+# master token regex: one C-level scan per token instead of per-character
+# Python dispatch. Alternatives are ordered to match the old dispatch order
+# (whitespace, comments, number, operator, name, tag); OPERATORS already
+# lists multi-character operators before their one-character prefixes.
+RE_TOKEN = re.compile(
+  r"(?P<ws>[" + WHITESPACE_CHARS + r"]+)"
+  r"|(?P<lc>//)"
+  r"|(?P<mlc>/\*)"
+  r"|(?P<num>\d*\.?\d+)"
+  r"|(?P<op>" + "|".join(re.escape(op) for op in OPERATORS) + r")"
+  r"|(?P<id>[A-Za-z_][0-9A-Za-z_]*)"
+  r"|(?P<tag>#[0-9A-Za-z_]*#)",
+  re.ASCII
+)
+
 def lexer(filename, include_paths):
   # find source file
   for include_path in include_paths:
@@ -176,26 +209,29 @@ def lexer(filename, include_paths):
       filename += ".cfs"
       break
   else:
-    error("Could not find source file `{0}'".format(filename))
+    error(f"Could not find source file `{filename}'")
 
-  # read source file
-  if src.has_key(filename):
+  # read source file, splitting into lines with the line endings dropped
+  if filename in src:
     return
   try:
     f = open(path, "r")
-    src[filename] = f.readlines()
+    src[filename] = f.read().splitlines()
     f.close()
   except IOError as e:
-    sys.exit("Error reading source file `{0}': {1}".format(filename, e))
+    sys.exit(f"Error reading source file `{filename}': {e}")
+
+  # bind hot lookups once: these run per token in the innermost loop
+  tokens_append = tokens.append
+  match_token = RE_TOKEN.match
 
   mode_mlc = False
   mode_include = False
   for line_no, line in enumerate(src[filename]):
     line_no += 1
-    line = line.rstrip("\r\n")
+    line_len = len(line)
     i = 0
-    while i < len(line):
-      sub = line[i:]
+    while i < line_len:
       col_no = i + 1
 
       # multi-line comment (end)
@@ -207,22 +243,20 @@ def lexer(filename, include_paths):
         i += 2
         continue
 
-      # whitespace
-      if sub[0] in WHITESPACE:
-        i += 1
-        continue
-
       # include (end)
       if mode_include:
-        if sub[0] in "<\"":
+        if line[i] in WHITESPACE:
+          i += 1
+          continue
+        if line[i] in "<\"":
           i += 1
         j = -1
-        for k in ">\"," + WHITESPACE:
+        for k in ">\"," + WHITESPACE_CHARS:
           j = line.find(k, i)
           if j != -1:
             break
         else:
-          j = len(line)
+          j = line_len
         include_filename = line[i:j]
         debug_print("include_filename", include_filename)
         lexer(include_filename, include_paths)
@@ -231,70 +265,59 @@ def lexer(filename, include_paths):
           mode_include = False
         continue
 
+      match = match_token(line, i)
+      if match is None:
+        # include (start): `#include' is not a token, so it lands here
+        for include_keyword in INCLUDE_KEYWORDS:
+          if line.startswith(include_keyword, i):
+            mode_include = True
+            i += len(include_keyword)
+            break
+        if mode_include:
+          continue
+        error(f"Unrecognized input: `{line[i:]}'", line_no, col_no, filename)
+      group = match.lastgroup
+      s = match.group()
+      i = match.end()
+
+      # whitespace
+      if group == "ws":
+        continue
+
       # line comment
-      if sub.startswith("//"):
+      if group == "lc":
         break
 
       # multi-line comment (start)
-      if sub.startswith("/*"):
+      if group == "mlc":
         mode_mlc = True
-        i += 2
-        continue
-
-      # include (start)
-      for include_keyword in INCLUDE_KEYWORDS:
-        if sub.startswith(include_keyword):
-          mode_include = True
-          i += len(include_keyword)
-          break
-      if mode_include:
         continue
 
       # number
-      match = RE_NUM.match(sub)
-      if match:
-        s = match.group()
-
+      if group == "num":
         # add a leading zero to bare decimal point
         if s[0] == ".":
           s = "0" + s
-
         num = float(s) if "." in s else int(s)
-        tokens.append((T_NUM, num, line_no, col_no, filename))
-        i += len(s)
-        continue
+        tokens_append((T_NUM, num, line_no, col_no, filename))
 
       # operator
-      found_op = False
-      for op in OPERATORS:
-        if sub.startswith(op):
-          tokens.append((T_OPER, op, line_no, col_no, filename))
-          i += len(op)
-          found_op = True
-          break
-      if found_op:
-        continue
+      elif group == "op":
+        tokens_append((T_OPER, intern(s), line_no, col_no, filename))
 
       # name
-      match = RE_ID.match(sub)
-      if match:
-        s = match.group()
-        if s in CONSTANTS:
-          tokens.append((T_NUM, s, line_no, col_no, filename))
+      elif group == "id":
+        # include (start)
+        if s in INCLUDE_KEYWORDS:
+          mode_include = True
+        elif s in CONSTANTS:
+          tokens_append((T_NUM, intern(s), line_no, col_no, filename))
         else:
-          tokens.append((T_ID, s, line_no, col_no, filename))
-        i += len(s)
-        continue
+          tokens_append((T_ID, intern(s), line_no, col_no, filename))
 
       # external tag
-      match = RE_TAG.match(sub)
-      if match:
-        s = match.group()
-        tokens.append((T_TAG, s, line_no, col_no, filename))
-        i += len(s)
-        continue
-
-      error("Unrecognized input: `{0}'".format(sub), line_no, col_no, filename)
+      else:
+        tokens_append((T_TAG, intern(s), line_no, col_no, filename))
 
 def consume():
   global ti
@@ -306,10 +329,12 @@ def consume():
 def expect_list(expected):
   if ti >= len(tokens):
     error("Unexpected end of input")
-  token_type, value = tokens[ti][:2]
+  token = tokens[ti]
+  token_type = token[0]
+  value = token[1]
   expected_text = []
   for expected_option in expected:
-    istype = type(expected_option).__name__ == "int"
+    istype = isinstance(expected_option, int)
     if istype:
       if token_type == expected_option:
         return consume()
@@ -317,36 +342,55 @@ def expect_list(expected):
     elif value == expected_option:
       return consume()
     else:
-      expected_text.append("`{0}'".format(expected_option))
+      expected_text.append(f"`{expected_option}'")
   oneof = ""
   if len(expected_text) > 1:
     oneof = "one of "
-  error("Expected {0}{1}, saw `{2}' ({3})".format(oneof, ", ".join(expected_text), value, T_NAMES[token_type]))
+  error(f"Expected {oneof}{', '.join(expected_text)}, saw `{value}' ({T_NAMES[token_type]})")
 
 def expect(expected):
   return expect_list([expected])
 
+# keyword and operator alternatives tested with one set lookup
+FUNC_KEYWORDS = frozenset(("function", "def", "double"))
+NOT_OPS = frozenset(("!", "not"))
+BODY_OPEN = frozenset((":", "{"))
+TERNARY_SEP = frozenset((":", ","))
+
+def accepts_list(expected, discard=True):
+  if ti >= len(tokens):
+    return False
+  if tokens[ti][1] in expected:
+    if discard:
+      consume()
+    return True
+  return False
+
 def accepts(expected, discard=True):
   if ti >= len(tokens):
     return False
-  token_type, value = tokens[ti][:2]
-  istype = type(expected).__name__ == "int"
+  token = tokens[ti]
+  token_type = token[0]
+  value = token[1]
+  istype = isinstance(expected, int)
   accepted = (istype and token_type == expected) or (not istype and value == expected)
   if accepted and discard:
     consume()
   return accepted
 
 def getfunction(function_name):
-  try:
-    return functions[function_name]
-  except:
-    return None
+  return functions.get(function_name)
+
+def make_function(parms, expr):
+  # functions table entries carry a parameter name -> position map so
+  # argument substitution avoids a linear parms scan per slot
+  return (parms, {parm: i for i, parm in enumerate(parms)}, expr)
 
 def getconst(const_name):
-  try:
-    return consts[(fn, const_name)]
-  except:
+  fn_consts = consts.get(fn)
+  if fn_consts is None:
     return None
+  return fn_consts.get(const_name)
 
 def is_num(expr1, expr2=None, expr3=None):
   if expr2 == None:
@@ -358,57 +402,185 @@ def is_num(expr1, expr2=None, expr3=None):
 def is_tag(expr1):
   return expr1[-1][0] == T_TAG and len(expr1) == 1
 
+def is_wrapped(expr):
+  # true when the opening paren at the front closes at the very end, so
+  # another wrap would only nest it redundantly
+  if expr[0][0] != T_OPER or expr[0][1] != "(":
+    return False
+  depth = 0
+  last = len(expr) - 1
+  for i, token in enumerate(expr):
+    if token[0] == T_OPER:
+      if token[1] == "(":
+        depth += 1
+      elif token[1] == ")":
+        depth -= 1
+        if depth == 0:
+          return i == last
+  return False
+
+def wrap_expression(expr):
+  # parenthesize in place unless the run is atomic or already wrapped
+  if not (is_num(expr) or is_tag(expr) or is_wrapped(expr)):
+    expr.insert(0, TOK_LPAREN)
+    expr.append(TOK_RPAREN)
+  return expr
+
+class Expr(list):
+  # token list that remembers whether it carries unresolved T_CONST slots,
+  # so simplify_expression can skip rescanning for them
+  has_const = True
+
 def deref_function(function_name, args):
-  value = []
-  fn_parms, fn_value = functions[function_name]
+  # substitute args for parameter slots in one pass, appending into a
+  # single result list instead of concatenating a wrapper list per token
+  value = Expr()
+  has_const = False
+  fn_parms, fn_parm_index, fn_value = functions[function_name]
   for fvalue in fn_value:
     if fvalue[0] == T_CONST and fvalue[1][0] == function_name:
       const_name = fvalue[1][1]
-      try:
-        fvalue = [(T_OPER, "(")] + args[fn_parms.index(const_name)] + [(T_OPER, ")")]
-      except:
+      parm_i = fn_parm_index.get(const_name)
+      if parm_i is None:
         if cmdline.allow_const:
-          fvalue = [fvalue]
+          value.append(fvalue)
+          has_const = True
         else:
-          error("Missing definition for const `{0}' in function `{1}'".format(const_name, function_name), ti_offset = -1)
+          error(f"Missing definition for const `{const_name}' in function `{function_name}'", ti_offset = -1)
+      else:
+        arg = args[parm_i]
+        value.append(TOK_LPAREN)
+        value.extend(arg)
+        value.append(TOK_RPAREN)
+        if not has_const:
+          has_const = any(token[0] == T_CONST for token in arg)
     else:
-      fvalue = [fvalue]
-    value += fvalue
-  if not (is_num(value) or is_tag(value)):
-    value = [(T_OPER, "(")] + value + [(T_OPER, ")")]
+      value.append(fvalue)
+      if fvalue[0] == T_CONST:
+        has_const = True
+  wrap_expression(value)
+  value.has_const = has_const
   return value
 
 def serialize_float(value):
+  # repr gives the shortest digit string that round-trips to the same
+  # float; Facer cannot parse exponent notation, so fall back to fixed
+  # notation for magnitudes where repr switches to it
   # http://stackoverflow.com/questions/6416474
-  p = ("%.*f" % (16, value)).partition(".")
-  return "".join((p[0], p[1], p[2][0], p[2][1:].rstrip("0")))
+  value_s = repr(value)
+  if "e" in value_s:
+    p = ("%.*f" % (16, value)).partition(".")
+    value_s = "".join((p[0], p[1], p[2][0], p[2][1:].rstrip("0")))
+  if value_s.endswith(".0"):
+    value_s = value_s[:-2]
+  return value_s
+
+def check_consts(expr):
+  # find forbidden consts with one scan up front instead of branching on
+  # every serialized token
+  for token in expr:
+    if token[0] == T_CONST:
+      function_name, const_name = token[1]
+      error(f"Missing definition for const `{const_name}' in function `{function_name}'")
+
+def serialize_token(token):
+  # a const serializes to its bare name
+  value = token[1][1] if token[0] == T_CONST else token[1]
+  if isinstance(value, float):
+    return serialize_float(value)
+  return str(value)
 
 def serialize_expression(expr, allow_const=True):
-  # serialize expression
-  expr_s = ""
-  for value in expr:
-    if value[0] == T_CONST:
-      if allow_const:
-        value = value[1][1]
-      else:
-        function_name, const_name = value[1]
-        error("Missing definition for const `{0}' in function `{1}'".format(const_name, function_name))
-    else:
-      value = value[1]
-    if type(value).__name__ == "float":
-      value_s = serialize_float(value)
-    else:
-      value_s = str(value)
-    if value_s.endswith(".0"):
-      value_s = value_s[:-2]
-    expr_s += value_s
-  return expr_s
+  if not allow_const:
+    check_consts(expr)
+
+  # serialize expression in one join instead of quadratic concatenation
+  return "".join(serialize_token(token) for token in expr)
+
+def write_expression(outfile, expr, allow_const=True):
+  # stream tokens straight to the destination instead of materializing the
+  # whole expression string first
+  if not allow_const:
+    check_consts(expr)
+  outfile.write("(")
+  for token in expr:
+    outfile.write(serialize_token(token))
+  outfile.write(")")
+
+def peephole(expr):
+  """
+  Collapse redundant parentheses in a finished expression: `(x)' becomes
+  `x' when x is a single number, tag, or const, and `((...))' becomes
+  `(...)'.  Numeric rewrites like `1*x' -> `x' are deliberately not
+  attempted: without reparsing, the surrounding operators can change the
+  meaning (consider `a/1*x').
+  """
+  changed = True
+  while changed:
+    changed = False
+
+    # match parentheses in one pass (the parser only emits balanced pairs)
+    matches = {}
+    stack = []
+    for i, token in enumerate(expr):
+      if token[0] == T_OPER:
+        if token[1] == "(":
+          stack.append(i)
+        elif token[1] == ")":
+          matches[stack.pop()] = i
+
+    drop = set()
+    for i, j in matches.items():
+      if j == i + 2:
+        # never strip a function call's argument parentheses
+        if i > 0 and expr[i - 1][0] in (T_FUNC, T_ID):
+          continue
+        inner = expr[i + 1]
+        if inner[0] == T_TAG or inner[0] == T_CONST or (inner[0] == T_NUM and (isinstance(inner[1], str) or inner[1] >= 0)):
+          drop.add(i)
+          drop.add(j)
+          changed = True
+      elif expr[i + 1][0] == T_OPER and expr[i + 1][1] == "(" and matches.get(i + 1) == j - 1:
+        drop.add(i)
+        drop.add(j)
+        changed = True
+    if drop:
+      expr = [token for i, token in enumerate(expr) if i not in drop]
+  return expr
+
+# simplified results keyed by (function name, input tokens); the same
+# library scaffolds (comparisons, logical operators, % and ^) are rebuilt
+# and re-simplified constantly, so identical inputs recur often
+simplify_cache = {}
+
+def cacheable_expression(expr):
+  # a bare identifier (not a call) resolves through the consts table,
+  # which is still growing while a function body is parsed, so those
+  # results cannot be reused safely
+  n = len(expr)
+  for i, token in enumerate(expr):
+    if token[0] == T_ID and (i + 1 == n or expr[i + 1][1] != "("):
+      return False
+  return True
 
 def simplify_expression(function_name, expr):
   global fn, tokens, ti
-  for token in expr:
-    if token[0] == T_CONST:
+  if isinstance(expr, Expr):
+    # deref_function already knows whether const slots remain
+    if expr.has_const:
       return expr
+  else:
+    for token in expr:
+      if token[0] == T_CONST:
+        return expr
+
+  key = (function_name, tuple(tuple(token) for token in expr))
+  cached = simplify_cache.get(key)
+  if cached is not None:
+    # T_FUNC tokens must stay mutable lists: the re-parse retypes them in
+    # place, so hand out fresh copies
+    return [list(token) if token[0] == T_FUNC else token for token in cached]
+  cache = cacheable_expression(expr)
 
   # save globals
   fn_orig = fn
@@ -435,120 +607,102 @@ def simplify_expression(function_name, expr):
   tokens = tokens_orig
   ti = ti_orig
   cmdline.debug = debug_orig
+
+  if cache:
+    # snapshot as tuples so later in-place token mutation by callers
+    # cannot corrupt the cached copy
+    simplify_cache[key] = tuple(tuple(token) for token in expr)
   return expr
 
+# compile-time folds for extern calls on a single numeric argument
+CALC_FUNCTIONS = {
+  "abs": abs,
+  "sin": math.sin,
+  "cos": math.cos,
+  "tan": math.tan,
+  "asin": math.asin,
+  "acos": math.acos,
+  "atan": math.atan,
+  "sinh": math.sinh,
+  "cosh": math.cosh,
+  "tanh": math.tanh,
+  "round": round,
+  "ceil": math.ceil,
+  "floor": math.floor,
+  "log": math.log,
+  "log2": math.log2,
+  "log10": math.log10,
+  "sqrt": math.sqrt,
+  "cbrt": lambda x: x ** (1.0 / 3),
+  "exp": math.exp,
+  "expm1": lambda x: math.exp(x) - 1,
+  "deg": lambda x: x * 180 / math.pi,
+  "rad": lambda x: x * math.pi / 180
+}
+
 def calc_function(expr):
   args = expr[2:-1]
   if not is_num(args):
     return expr
-  arg1 = args[0][1]
-  function_name = expr[0][1]
+  function = CALC_FUNCTIONS.get(expr[0][1])
+  if function is None:
+    return expr
+  arg1 = deref_tag(args[0])
   try:
-    if function_name == "abs":
-      token = [[T_NUM, abs(arg1)]]
-    elif function_name == "sin":
-      token = [[T_NUM, math.sin(arg1)]]
-    elif function_name == "cos":
-      token = [[T_NUM, math.cos(arg1)]]
-    elif function_name == "tan":
-      token = [[T_NUM, math.tan(arg1)]]
-    elif function_name == "asin":
-      token = [[T_NUM, math.asin(arg1)]]
-    elif function_name == "acos":
-      token = [[T_NUM, math.acos(arg1)]]
-    elif function_name == "atan":
-      token = [[T_NUM, math.atan(arg1)]]
-    elif function_name == "sinh":
-      token = [[T_NUM, math.sinh(arg1)]]
-    elif function_name == "cosh":
-      token = [[T_NUM, math.cosh(arg1)]]
-    elif function_name == "tanh":
-      token = [[T_NUM, math.tanh(arg1)]]
-    elif function_name == "round":
-      token = [[T_NUM, round(arg1)]]
-    elif function_name == "ceil":
-      token = [[T_NUM, math.ceil(arg1)]]
-    elif function_name == "floor":
-      token = [[T_NUM, math.floor(arg1)]]
-    elif function_name == "log":
-      token = [[T_NUM, math.log(arg1)]]
-    elif function_name == "log2":
-      token = [[T_NUM, math.log(arg1) / math.log(2)]]
-    elif function_name == "log10":
-      token = [[T_NUM, math.log10(arg1)]]
-    elif function_name == "sqrt":
-      token = [[T_NUM, math.sqrt(arg1)]]
-    elif function_name == "cbrt":
-      token = [[T_NUM, arg1 ** (1.0 / 3)]]
-    elif function_name == "exp":
-      token = [[T_NUM, math.exp(arg1)]]
-    elif function_name == "expm1":
-      token = [[T_NUM, math.exp(arg1) - 1]]
-    elif function_name == "deg":
-      token = [[T_NUM, arg1 * 180 / math.pi]]
-    elif function_name == "rad":
-      token = [[T_NUM, arg1 * math.pi / 180]]
-  except ValueError as e:
-    error("Error calculating `{0}'".format(serialize_expression(expr)))
-  return token
+    return [[T_NUM, function(arg1)]]
+  except ValueError:
+    error(f"Error calculating `{serialize_expression(expr)}'")
 
 def deref_tag(token):
   value = token[1]
-  try:
-    return CONSTANTS[value]
-  except:
-    return value
+  return CONSTANTS.get(value, value)
+
+# compile-time folds for unary and binary operators
+CALC_UNARY = {
+  "(-)": lambda a: -a,
+  "!": lambda a: 1 - a
+}
+
+CALC_BINARY = {
+  "^": lambda a, b: a ** b,
+  "*": lambda a, b: a * b,
+  "&&": lambda a, b: a * b,
+  "?": lambda a, b: a * b,
+  "/": lambda a, b: a / float(b),
+  "%": lambda a, b: a % b,
+  "+": lambda a, b: a + b,
+  "-": lambda a, b: a - b,
+  "<=": lambda a, b: int(a <= b),
+  ">=": lambda a, b: int(a >= b),
+  "<:": lambda a, b: int(a < b),
+  "<": lambda a, b: int(a < b),
+  ">:": lambda a, b: int(a > b),
+  ">": lambda a, b: int(a > b),
+  "==": lambda a, b: int(a == b),
+  "!=": lambda a, b: int(a != b),
+  "||": lambda a, b: 1 - (1 - a) * (1 - b)
+}
 
 def calc_expression(operator, expr1, expr2=None, expr3=None):
-  arg1 = None
   arg2 = None
   arg3 = None
   if expr2 == None:
     arg1 = deref_tag(expr1[0])
-  else:
+    value = CALC_UNARY[operator](arg1)
+  elif expr3 == None:
     arg1 = deref_tag(expr1[-1])
     arg2 = deref_tag(expr2[0])
-    if expr3 != None:
-      arg3 = deref_tag(expr3[0])
-  if operator == "(-)":
-    value = -arg1
-  elif operator == "!":
-    value = 1 - arg1
-  elif operator == "^":
-    value = arg1 ** arg2
-  elif operator == "*" or operator == "&&" or operator == "?":
-    value = arg1 * arg2
-  elif operator == "/":
-    try:
-      value = arg1 / float(arg2)
-    except ZeroDivisionError as e:
-      error("Division by zero calculating `{0} / {1}'".format(arg1, arg2))
-  elif operator == "%":
     try:
-      value = arg1 % arg2
+      value = CALC_BINARY[operator](arg1, arg2)
     except ZeroDivisionError as e:
-      error("Division by zero calculating `{0} % {1}'".format(arg1, arg2))
-  elif operator == "+":
-    value = arg1 + arg2
-  elif operator == "-":
-    value = arg1 - arg2
-  elif operator == "<=":
-    value = int(arg1 <= arg2)
-  elif operator == ">=":
-    value = int(arg1 >= arg2)
-  elif operator == "<:" or operator == "<":
-    value = int(arg1 < arg2)
-  elif operator == ">:" or operator == ">":
-    value = int(arg1 > arg2)
-  elif operator == "==":
-    value = int(arg1 == arg2)
-  elif operator == "!=":
-    value = int(arg1 != arg2)
-  elif operator == "||":
-    value = 1 - (1 - arg1) * (1 - arg2)
-  elif operator == "?:":
+      error(f"Division by zero calculating `{arg1} {operator} {arg2}'")
+  else:
+    # b ? t : f -> b * (t - f) + f
+    arg1 = deref_tag(expr1[-1])
+    arg2 = deref_tag(expr2[0])
+    arg3 = deref_tag(expr3[0])
     value = arg1 * (arg2 - arg3) + arg3
-  debug_print("calc: operator=[{0}], exprs=[{1} {2} {3}], args=[{4} {5} {6}]={7}".format(operator, expr1, expr2, expr3, arg1, arg2, arg3, value))
+  debug_print(f"calc: operator=[{operator}], exprs=[{expr1} {expr2} {expr3}], args=[{arg1} {arg2} {arg3}]={value}")
   token = [[T_NUM, value]]
   return token
 
@@ -566,11 +720,7 @@ def parse_primary_expression():
 
   # parentheses
   if accepts("("):
-    expr = parse_expression()
-    if is_num(expr) or is_tag(expr):
-      lvalue += expr
-    else:
-      lvalue += [(T_OPER, "(")] + expr + [(T_OPER, ")")]
+    lvalue.extend(wrap_expression(parse_expression()))
     expect(")")
 
   # consts and functions
@@ -580,66 +730,73 @@ def parse_primary_expression():
     # function
     if accepts("("):
       function_name = name
-      debug_print("==[start {0}]".format(function_name) + ("=" * (70 - len(function_name))))
+      debug_print(f"==[start {function_name}]" + ("=" * (70 - len(function_name))))
       # get function declaration and generated expression
       function = getfunction(function_name)
       if function is None:
-        error("Missing function declaration for `{0}'".format(function_name))
-      fn_parms, fn_expr = function
+        error(f"Missing function declaration for `{function_name}'")
+      fn_parms, fn_parm_index, fn_expr = function
 
       # compare args to parms
+      # the debug traces below serialize large token runs, so only build
+      # them when --debug is on
       args = []
       if not accepts(")"):
-        debug_print("args function_name=[{0}], arg#={1}, expr=`{2}' ===> `{3}'".format(function_name, len(args), serialize_expression(tokens[:ti]), serialize_expression(tokens[ti:])))
+        if cmdline.debug:
+          debug_print(f"args function_name=[{function_name}], arg#={len(args)}, expr=`{serialize_expression(tokens[:ti])}' ===> `{serialize_expression(tokens[ti:])}'")
         expr = parse_expression()
         args.append(expr)
-        debug_print("expr function_name=[{0}], arg#={1}, expr=`{2}'".format(function_name, len(args), serialize_expression(expr)))
+        if cmdline.debug:
+          debug_print(f"expr function_name=[{function_name}], arg#={len(args)}, expr=`{serialize_expression(expr)}'")
 
         while not accepts(")"):
           accepts(",")
-          debug_print("args function_name=[{0}], arg#={1}, expr=`{2}' ===> `{3}'".format(function_name, len(args), serialize_expression(tokens[:ti]), serialize_expression(tokens[ti:])))
+          if cmdline.debug:
+            debug_print(f"args function_name=[{function_name}], arg#={len(args)}, expr=`{serialize_expression(tokens[:ti])}' ===> `{serialize_expression(tokens[ti:])}'")
           expr = parse_expression()
           args.append(expr)
-          debug_print("expr function_name=[{0}], arg#={1}, expr=`{2}'".format(function_name, len(args), serialize_expression(expr)))
-        debug_print("args (end) function_name=[{0}], arg#={1}, expr=`{2}' ===> `{3}'".format(function_name, len(args), serialize_expression(tokens[:ti]), serialize_expression(tokens[ti:])))
+          if cmdline.debug:
+            debug_print(f"expr function_name=[{function_name}], arg#={len(args)}, expr=`{serialize_expression(expr)}'")
+        if cmdline.debug:
+          debug_print(f"args (end) function_name=[{function_name}], arg#={len(args)}, expr=`{serialize_expression(tokens[:ti])}' ===> `{serialize_expression(tokens[ti:])}'")
       if len(args) != len(fn_parms):
         if len(fn_parms) > 0:
-          parms = ": `{0}'".format(", ".join(fn_parms))
+          parms = f": `{', '.join(fn_parms)}'"
         else:
           parms = ""
-        error("Function `{0}' expects {1} arguments{2}, got {3}".format(function_name, len(fn_parms), parms, len(args)))
+        error(f"Function `{function_name}' expects {len(fn_parms)} arguments{parms}, got {len(args)}")
 
       # extern functions have no associated expression except function call
       if fn_expr is None:
-        fn_expr = [[T_FUNC, function_name], (T_OPER, "(")]
-        first = True
-        for arg in args:
-          if first:
-            first = False
-          fn_expr += arg
-        fn_expr += [(T_OPER, ")")]
+        fn_expr = [[T_FUNC, function_name], TOK_LPAREN]
+        for argi, arg in enumerate(args):
+          if argi > 0:
+            fn_expr.append(TOK_COMMA)
+          fn_expr.extend(arg)
+        fn_expr.append(TOK_RPAREN)
         lvalue += calc_function(fn_expr)
 
       # user functions or interns: substitute args for locals
       else:
         expr = deref_function(function_name, args)
-        debug_print("deref: {0}".format(serialize_expression(expr)))
+        if cmdline.debug:
+          debug_print(f"deref: {serialize_expression(expr)}")
         expr = simplify_expression(function_name, expr)
-        debug_print("simplify: {0}".format(serialize_expression(expr)))
+        if cmdline.debug:
+          debug_print(f"simplify: {serialize_expression(expr)}")
         lvalue += expr
-      debug_print("==[end {0}]".format(function_name) + ("=" * (72 - len(function_name))))
+      debug_print(f"==[end {function_name}]" + ("=" * (72 - len(function_name))))
 
     # const
     else:
       const_name = name
       const_expr = getconst(const_name)
       if const_expr is None:
-        lvalue += [(T_CONST, (fn, const_name))]
+        lvalue.append((T_CONST, (fn, const_name)))
       else:
-        if is_num(const_expr):
-          lvalue += const_expr
-        else:
-          lvalue += [(T_OPER, "(")] + const_expr + [(T_OPER, ")")]
+        # wrapping mutates the stored const once; later references reuse
+        # the wrapped form
+        lvalue.extend(wrap_expression(const_expr))
 
   # numeric value
   elif accepts(T_NUM, False):
@@ -674,216 +831,159 @@ def parse_unary_expression():
     if is_num(rvalue):
       lvalue = calc_expression("(-)", rvalue)
     else:
-      lvalue = [(T_OPER, "-")] + rvalue
-  elif accepts("!") or accepts("not"):
+      lvalue = [TOK_MINUS]
+      lvalue.extend(rvalue)
+  elif accepts_list(NOT_OPS):
     rvalue = parse_primary_expression()
     if is_num(rvalue):
       lvalue = calc_expression("!", rvalue)
     else:
-      lvalue = simplify_expression(fn, [(T_OPER, "("), (T_NUM, 1), (T_OPER, "-")] + rvalue + [(T_OPER, ")")])
+      expr = [TOK_LPAREN, TOK_ONE, TOK_MINUS]
+      expr.extend(rvalue)
+      expr.append(TOK_RPAREN)
+      lvalue = simplify_expression(fn, expr)
   else:
     lvalue = parse_primary_expression()
   debug_out()
   return lvalue
 
 """
-exp_expression =
-    unary_expression { "^" unary_expression }
+binary_expression =
+    unary_expression { BINOP unary_expression }
     ;
-"""
-def parse_exp_expression():
-  debug_in()
-  lvalue = parse_unary_expression()
-  while True:
-    if accepts("^"):
-      rvalue = parse_unary_expression()
-      if is_num(lvalue, rvalue):
-        lvalue = lvalue[:-1] + calc_expression("^", lvalue, rvalue)
-      else:
-        lvalue = simplify_expression(fn, [(T_ID, "exp"), (T_OPER, "("), (T_ID, "log"), (T_OPER, "(")] + lvalue + [(T_OPER, ")"), (T_OPER, "*")] + rvalue + [(T_OPER, ")")])
-    else:
-      break
-  debug_out()
-  return lvalue
 
+Binary operators are parsed with a shunting-yard loop over BIN_PREC using
+explicit operator and operand stacks instead of one recursive function per
+precedence level.  All operators are left-associative; the table mirrors
+the grammar ladder (exp, mult, add, rel, equ, and, or).
 """
-mult_expression =
-    exp_expression { ( "*" | "/" | "%" ) exp_expression }
-    ;
-"""
-def parse_mult_expression():
-  debug_in()
-  lvalue = parse_exp_expression()
-  while True:
-    if accepts("*"):
-      rvalue = parse_exp_expression()
-      if is_num(lvalue, rvalue):
-        lvalue = lvalue[:-1] + calc_expression("*", lvalue, rvalue)
-      else:
-        lvalue += [(T_OPER, "*")] + rvalue
-    elif accepts("/"):
-      rvalue = parse_exp_expression()
-      if is_num(lvalue, rvalue):
-        lvalue = lvalue[:-1] + calc_expression("/", lvalue, rvalue)
-      else:
-        lvalue += [(T_OPER, "/")] + rvalue
-    elif accepts("%"):
-      rvalue = parse_exp_expression()
-      if is_num(lvalue, rvalue):
-        lvalue = lvalue[:-1] + calc_expression("%", lvalue, rvalue)
-      else:
-        lvalue = simplify_expression(fn, lvalue + [(T_OPER, "-"), (T_OPER, "(")] + rvalue + [(T_OPER, "*"), [T_ID, "floor"], (T_OPER, "(")] + lvalue + [(T_OPER, "/")] + rvalue + [(T_OPER, ")"), (T_OPER, ")")])
-    else:
-      break
-  debug_out()
-  return lvalue
+BIN_PREC = {
+  "||": 1, "or": 1,
+  "&&": 2, "and": 2,
+  "==": 3, "=": 3, "!=": 3, "<>": 3,
+  "<=": 4, ">=": 4, "<:": 4, ">:": 4, "<": 4, ">": 4,
+  "+": 5, "-": 5,
+  "*": 6, "/": 6, "%": 6,
+  "^": 7
+}
 
-"""
-add_expression =
-    mult_expression { ( "+" | "-" ) mult_expression }
-    ;
-"""
-def parse_add_expression():
-  debug_in()
-  lvalue = parse_mult_expression()
-  while True:
-    if accepts("+"):
-      rvalue = parse_mult_expression()
-      if is_num(lvalue, rvalue):
-        lvalue = lvalue[:-1] + calc_expression("+", lvalue, rvalue)
-      else:
-        lvalue += [(T_OPER, "+")] + rvalue
-    elif accepts("-"):
-      rvalue = parse_mult_expression()
-      if is_num(lvalue, rvalue):
-        lvalue = lvalue[:-1] + calc_expression("-", lvalue, rvalue)
-      else:
-        lvalue += [(T_OPER, "-")] + rvalue
-    else:
-      break
-  debug_out()
-  return lvalue
+# operator spellings that fold with another operator's calculation rule
+CALC_ALIASES = {"=": "==", "<>": "!=", "and": "&&", "or": "||"}
 
-"""
-rel_expression =
-    add_expression { ( "<=" | ">=" | "<:" | ">:" | "<" | ">" ) add_expression }
-    ;
-"""
-def parse_rel_expression():
-  debug_in()
-  lvalue = parse_add_expression()
-  while True:
-    if accepts("<="):
-      rvalue = parse_add_expression()
-      if is_num(lvalue, rvalue):
-        lvalue = lvalue[:-1] + calc_expression("<=", lvalue, rvalue)
-      else:
-        lvalue = simplify_expression(fn, deref_function("__<=", (lvalue, rvalue)))
-    elif accepts(">="):
-      rvalue = parse_add_expression()
-      if is_num(lvalue, rvalue):
-        lvalue = lvalue[:-1] + calc_expression(">=", lvalue, rvalue)
-      else:
-        lvalue = simplify_expression(fn, deref_function("__>=", (lvalue, rvalue)))
-    elif accepts("<:"):
-      rvalue = parse_add_expression()
-      if is_num(lvalue, rvalue):
-        lvalue = lvalue[:-1] + calc_expression("<:", lvalue, rvalue)
-      else:
-        lvalue = simplify_expression(fn, deref_function("__<:", (lvalue, rvalue)))
-    elif accepts(">:"):
-      rvalue = parse_add_expression()
-      if is_num(lvalue, rvalue):
-        lvalue = lvalue[:-1] + calc_expression(">:", lvalue, rvalue)
-      else:
-        lvalue = simplify_expression(fn, deref_function("__>:", (lvalue, rvalue)))
-    elif accepts("<"):
-      rvalue = parse_add_expression()
-      if is_num(lvalue, rvalue):
-        lvalue = lvalue[:-1] + calc_expression("<", lvalue, rvalue)
-      else:
-        lvalue = simplify_expression(fn, deref_function("__<", (lvalue, rvalue)))
-    elif accepts(">"):
-      rvalue = parse_add_expression()
-      if is_num(lvalue, rvalue):
-        lvalue = lvalue[:-1] + calc_expression(">", lvalue, rvalue)
-      else:
-        lvalue = simplify_expression(fn, deref_function("__>", (lvalue, rvalue)))
-    else:
-      break
-  debug_out()
-  return lvalue
+# comparison operators desugar through their library function
+REL_FUNCTIONS = {
+  "<=": "__<=", ">=": "__>=", "<:": "__<:", ">:": "__>:", "<": "__<",
+  ">": "__>", "==": "__==", "=": "__==", "!=": "__!=", "<>": "__!="
+}
 
-"""
-equ_expression =
-    rel_expression { ( "==" | "=" | "!=" | "<>" ) rel_expression }
-    ;
-"""
-def parse_equ_expression():
-  debug_in()
-  lvalue = parse_rel_expression()
-  while True:
-    if accepts("==") or accepts("="):
-      rvalue = parse_rel_expression()
-      if is_num(lvalue, rvalue):
-        lvalue = lvalue[:-1] + calc_expression("==", lvalue, rvalue)
-      else:
-        lvalue = simplify_expression(fn, deref_function("__==", (lvalue, rvalue)))
-    elif accepts("!=") or accepts("<>"):
-      rvalue = parse_rel_expression()
-      if is_num(lvalue, rvalue):
-        lvalue = lvalue[:-1] + calc_expression("!=", lvalue, rvalue)
-      else:
-        lvalue = simplify_expression(fn, deref_function("__!=", (lvalue, rvalue)))
-    else:
-      break
-  debug_out()
-  return lvalue
+def seam_fold_possible(lvalue, rvalue):
+  # re-parsing a desugared scaffold only changes it when a numeric token
+  # sits at a seam between scaffold and operand, where constant folding
+  # can kick in; every other scaffold re-parses to itself
+  return (lvalue[0][0] == T_NUM or lvalue[-1][0] == T_NUM
+          or rvalue[0][0] == T_NUM or rvalue[-1][0] == T_NUM)
+
+def combine_binary_expression(operator, lvalue, rvalue):
+  calc_op = CALC_ALIASES.get(operator, operator)
+
+  # both sides numeric: fold at compile time
+  if is_num(lvalue, rvalue):
+    return lvalue[:-1] + calc_expression(calc_op, lvalue, rvalue)
+
+  # x ^ y -> exp(log(x) * y)
+  if operator == "^":
+    expr = [(T_ID, "exp"), TOK_LPAREN, (T_ID, "log"), TOK_LPAREN]
+    expr.extend(lvalue)
+    expr += (TOK_RPAREN, TOK_MUL)
+    expr.extend(rvalue)
+    expr.append(TOK_RPAREN)
+    return simplify_expression(fn, expr)
+
+  if operator == "*":
+    lvalue.append(TOK_MUL)
+    lvalue.extend(rvalue)
+    return lvalue
+
+  if operator == "/":
+    lvalue.append(TOK_DIV)
+    lvalue.extend(rvalue)
+    return lvalue
+
+  # x % y -> x - (y * floor(x / y))
+  if operator == "%":
+    expr = list(lvalue)
+    expr += (TOK_MINUS, TOK_LPAREN)
+    expr.extend(rvalue)
+    expr += (TOK_MUL, TOK_FLOOR, TOK_LPAREN)
+    expr.extend(lvalue)
+    expr.append(TOK_DIV)
+    expr.extend(rvalue)
+    expr += (TOK_RPAREN, TOK_RPAREN)
+    return simplify_expression(fn, expr)
+
+  if operator == "+":
+    lvalue.append(TOK_PLUS)
+    lvalue.extend(rvalue)
+    return lvalue
+
+  if operator == "-":
+    lvalue.append(TOK_MINUS)
+    lvalue.extend(rvalue)
+    return lvalue
+
+  # comparisons desugar through the library
+  rel_function = REL_FUNCTIONS.get(operator)
+  if rel_function is not None:
+    return simplify_expression(fn, deref_function(rel_function, (lvalue, rvalue)))
+
+  # x && y -> (x * y)
+  if calc_op == "&&":
+    expr = [TOK_LPAREN]
+    expr.extend(lvalue)
+    expr.append(TOK_MUL)
+    expr.extend(rvalue)
+    expr.append(TOK_RPAREN)
+    if seam_fold_possible(lvalue, rvalue):
+      return simplify_expression(fn, expr)
+    return expr
 
-"""
-and_expression =
-    equ_expression { ( "&&" | "and" ) equ_expression }
-    ;
-"""
-def parse_and_expression():
-  debug_in()
-  lvalue = parse_equ_expression()
-  while True:
-    if accepts("&&") or accepts("and"):
-      rvalue = parse_equ_expression()
-      if is_num(lvalue, rvalue):
-        lvalue = lvalue[:-1] + calc_expression("&&", lvalue, rvalue)
-      else:
-        lvalue = simplify_expression(fn, [(T_OPER, "(")] + lvalue + [(T_OPER, "*")] + rvalue + [(T_OPER, ")")])
-    else:
-      break
-  debug_out()
-  return lvalue
+  # x || y -> (1 - (1 - x) * (1 - y))
+  expr = [TOK_LPAREN, TOK_ONE, TOK_MINUS, TOK_LPAREN, TOK_ONE, TOK_MINUS]
+  expr.extend(lvalue)
+  expr += (TOK_RPAREN, TOK_MUL, TOK_LPAREN, TOK_ONE, TOK_MINUS)
+  expr.extend(rvalue)
+  expr += (TOK_RPAREN, TOK_RPAREN)
+  if seam_fold_possible(lvalue, rvalue):
+    return simplify_expression(fn, expr)
+  return expr
 
-"""
-or_expression =
-    and_expression { ( "||" | "or" ) and_expression }
-    ;
-"""
-def parse_or_expression():
+def parse_binary_expression():
   debug_in()
-  lvalue = parse_and_expression()
-  while True:
-    if accepts("||") or accepts("or"):
-      rvalue = parse_and_expression()
-      if is_num(lvalue, rvalue):
-        lvalue = lvalue[:-1] + calc_expression("||", lvalue, rvalue)
-      else:
-        lvalue = simplify_expression(fn, [(T_OPER, "("), (T_NUM, 1), (T_OPER, "-"), (T_OPER, "("), (T_NUM, 1), (T_OPER, "-")] + lvalue + [(T_OPER, ")"), (T_OPER, "*"), (T_OPER, "("), (T_NUM, 1), (T_OPER, "-")] + rvalue + [(T_OPER, ")"), (T_OPER, ")")])
-    else:
+  values = [parse_unary_expression()]
+  operators = []
+  while ti < len(tokens):
+    operator = tokens[ti][1]
+    prec = BIN_PREC.get(operator)
+    if prec is None:
       break
+    # left-associative: reduce pending operators of equal or higher
+    # precedence before shifting the new one
+    while operators and BIN_PREC[operators[-1]] >= prec:
+      rvalue = values.pop()
+      values[-1] = combine_binary_expression(operators.pop(), values[-1], rvalue)
+    operators.append(operator)
+    consume()
+    values.append(parse_unary_expression())
+  while operators:
+    rvalue = values.pop()
+    values[-1] = combine_binary_expression(operators.pop(), values[-1], rvalue)
   debug_out()
-  return lvalue
+  return values[0]
 
 """
 expression =
     "if" "(" expression ( "?" | "," ) expression [ ( ":" | "," ) expression ] ")"
-    | or_expression
+    | binary_expression
     ;
 """
 def parse_expression():
@@ -897,20 +997,37 @@ def parse_expression():
     bvalue = parse_expression()
     expect_list(["?", ","])
     tvalue = parse_expression()
-    if accepts(":") or accepts(","):
+    if accepts_list(TERNARY_SEP):
       fvalue = parse_expression()
       if is_num(bvalue, tvalue, fvalue):
-        lvalue = lvalue[:-1] + calc_expression("?:", bvalue, tvalue, fvalue)
+        lvalue = bvalue[:-1] + calc_expression("?:", bvalue, tvalue, fvalue)
       else:
-        lvalue = simplify_expression(fn, [(T_OPER, "(")] + bvalue + [(T_OPER, "*"), (T_OPER, "(")] + tvalue + [(T_OPER, "-")] + fvalue + [(T_OPER, ")"), (T_OPER, "+")] + fvalue + [(T_OPER, ")")])
+        expr = [TOK_LPAREN]
+        expr.extend(bvalue)
+        expr += (TOK_MUL, TOK_LPAREN)
+        expr.extend(tvalue)
+        expr.append(TOK_MINUS)
+        expr.extend(fvalue)
+        expr += (TOK_RPAREN, TOK_PLUS)
+        expr.extend(fvalue)
+        expr.append(TOK_RPAREN)
+        lvalue = simplify_expression(fn, expr)
     else:
       if is_num(bvalue, tvalue):
-        lvalue = lvalue[:-1] + calc_expression("?", bvalue, tvalue)
+        lvalue = bvalue[:-1] + calc_expression("?", bvalue, tvalue)
       else:
-        lvalue = simplify_expression(fn, [(T_OPER, "(")] + bvalue + [(T_OPER, "*")] + tvalue + [(T_OPER, ")")])
+        expr = [TOK_LPAREN]
+        expr.extend(bvalue)
+        expr.append(TOK_MUL)
+        expr.extend(tvalue)
+        expr.append(TOK_RPAREN)
+        if seam_fold_possible(bvalue, tvalue):
+          lvalue = simplify_expression(fn, expr)
+        else:
+          lvalue = expr
     expect(")")
   else:
-    lvalue = parse_or_expression()
+    lvalue = parse_binary_expression()
 
   debug_out()
   return lvalue
@@ -924,11 +1041,11 @@ def parse_statement():
   debug_in()
   const_name = expect(T_ID)
   if getconst(const_name) is not None:
-    error("Duplicate const declaration for `{0}'".format(const_name))
+    error(f"Duplicate const declaration for `{const_name}'")
   expect("=")
   rvalue = parse_expression()
-  consts[(fn, const_name)] = rvalue
-  debug_print("{0}.{1}".format(fn, const_name), rvalue)
+  consts[fn][const_name] = rvalue
+  debug_print(f"{fn}.{const_name}", rvalue)
   debug_out()
 
 """
@@ -940,32 +1057,44 @@ def parse_function():
   global fn
 
   debug_in()
-  accepts("function") or accepts("def") or accepts("double")
+  accepts_list(FUNC_KEYWORDS)
   fn = expect(T_ID)
   debug_print("fn", fn)
   if getfunction(fn) is not None:
-    error("Duplicate function declaration for `{0}'".format(fn))
+    error(f"Duplicate function declaration for `{fn}'")
+  consts[fn] = {}
   expect("(")
-  parms = []
+  # count the parameters ahead so the list is allocated at its final
+  # size and filled by index instead of grown append by append
+  scan = ti
+  n = len(tokens)
+  count = 0
+  while scan < n and tokens[scan][1] != ")":
+    if tokens[scan][0] == T_ID:
+      count += 1
+    scan += 1
+  parms = [None] * count
   if not accepts(")"):
-    parms.append(expect(T_ID))
+    parms[0] = expect(T_ID)
+    parm_i = 1
     while not accepts(")"):
       accepts(",")
-      parms.append(expect(T_ID))
+      parms[parm_i] = expect(T_ID)
+      parm_i += 1
   debug_print("parms", parms)
 
   # verify that main has no parms
   if fn == cmdline.main and len(parms) > 0:
-    error("Function `{0}' must not take arguments".format(cmdline.main))
+    error(f"Function `{cmdline.main}' must not take arguments")
 
-  accepts(":") or accepts("{")
+  accepts_list(BODY_OPEN)
   while not accepts("return"):
     parse_statement()
     accepts(";")
   expr = parse_expression()
   accepts(";")
   accepts("}")
-  functions[fn] = (parms, expr)
+  functions[fn] = make_function(parms, expr)
   debug_out()
 
 """
@@ -975,38 +1104,96 @@ program =
 """
 def parse_program():
   debug_in()
+  # the token stream is fixed once lexing is done
+  n = len(tokens)
   while True:
     parse_function()
-    if ti >= len(tokens):
+    if ti >= n:
       break
   debug_out()
 
 def parse():
   parse_program()
 
+argument_parser = None
+
+def get_argument_parser():
+  # built on first use and kept, so repeated main() calls (e.g. driving
+  # the compiler from another script) reuse one parser
+  global argument_parser
+  if argument_parser is None:
+    parser = argparse.ArgumentParser(prog="cfs", description="Closed-Form Script Compiler.")
+    parser.add_argument("-v", "--version", action="version", version="%(prog)s " + VERSION)
+    parser.add_argument("-d", "--debug", action="store_true", dest="debug", help="output verbose debugging information")
+    parser.add_argument("-c", "--allow-const", action="store_true", dest="allow_const", help="don't generate an error on missing consts")
+    parser.add_argument("-m", "--main", dest="main", default="main", metavar="FUNC", help="invoke function FUNC instead of main()")
+    parser.add_argument("-i", "--include", dest="include", default="/usr/local/share/cfs", metavar="PATH", help="standard include file PATH")
+    parser.add_argument("-o", dest="dest", metavar="DEST", help="write output into file DEST instead of stdout")
+    parser.add_argument("src", metavar="SOURCE", help="file containing program to compile")
+    argument_parser = parser
+  return argument_parser
+
 def main():
-  global cmdline, tokens
+  global cmdline, tokens, debug_print, debug_in, debug_out
 
   # parse command line arguments
-  parser = argparse.ArgumentParser(prog="cfs", description="Closed-Form Script Compiler.")
-  parser.add_argument("-v", "--version", action="version", version="%(prog)s " + VERSION)
-  parser.add_argument("-d", "--debug", action="store_true", dest="debug", help="output verbose debugging information")
-  parser.add_argument("-c", "--allow-const", action="store_true", dest="allow_const", help="don't generate an error on missing consts")
-  parser.add_argument("-m", "--main", dest="main", default="main", metavar="FUNC", help="invoke function FUNC instead of main()")
-  parser.add_argument("-i", "--include", dest="include", default="/usr/local/share/cfs", metavar="PATH", help="standard include file PATH")
-  parser.add_argument("-o", dest="dest", metavar="DEST", help="write output into file DEST instead of stdout")
-  parser.add_argument("src", metavar="SOURCE", help="file containing program to compile")
-  cmdline = parser.parse_args()
-
-  # load external and library functions
-  debug_orig = cmdline.debug
-  cmdline.debug = False
+  cmdline = get_argument_parser().parse_args()
+
+  # --debug never turns on after startup, so without it replace the
+  # tracers outright and spare every parse step the call and flag check
+  if not cmdline.debug:
+    debug_print = debug_in = debug_out = lambda *args: None
+
+  # load external functions
   for name, parms in EXTERNS:
-    functions[name] = (parms, None)
-  for name, parms, expr in LIBRARY:
-    expr = simplify_expression(name, expr)
-    functions[name] = (parms, expr)
-  cmdline.debug = debug_orig
+    functions[name] = make_function(parms, None)
+
+  # load library functions, reusing a cached parse when available: the
+  # library token lists are fixed constants, so their simplified form only
+  # changes when the library (or the interpreter) does
+  # the leading number is the functions table entry format; bump it when
+  # the shape of the cached entries changes
+  # the simplified bodies also depend on the externs table and on which
+  # functions get constant-folded, so those are part of the key too
+  key = hashlib.sha256(repr((2, VERSION, sys.version, EXTERNS, LIBRARY,
+      sorted(CALC_FUNCTIONS))).encode("utf-8")).hexdigest()
+  # the cache is a pickle, so it must live in a directory only this user
+  # can write to: unpickling a file another user planted would run their
+  # code; on platforms without uids (Windows) skip the cache entirely
+  getuid = getattr(os, "getuid", None)
+  cache_path = None
+  if getuid is not None:
+    cache_dir = os.path.join(tempfile.gettempdir(), f"cfs-{getuid()}")
+    try:
+      os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+      os.chmod(cache_dir, 0o700)
+      if os.stat(cache_dir).st_uid == getuid():
+        cache_path = os.path.join(cache_dir, f"cfs-lib-{key}.pkl")
+    except OSError:
+      pass
+  library = None
+  if cache_path is not None:
+    try:
+      with open(cache_path, "rb") as cache_file:
+        library = pickle.load(cache_file)
+    except Exception:
+      pass
+  if library is None:
+    debug_orig = cmdline.debug
+    cmdline.debug = False
+    library = {}
+    for name, parms, expr in LIBRARY:
+      # register as we go: later library functions call earlier ones
+      functions[name] = library[name] = make_function(parms, simplify_expression(name, expr))
+    cmdline.debug = debug_orig
+    if cache_path is not None:
+      try:
+        with open(cache_path, "wb") as cache_file:
+          pickle.dump(library, cache_file)
+      except (IOError, OSError):
+        pass
+  else:
+    functions.update(library)
 
   # parse into tokens
   include_paths = [os.path.dirname(cmdline.src), cmdline.include]
@@ -1022,21 +1209,27 @@ def main():
   debug_print("consts", consts)
 
   # verify main function exists
-  if not functions.has_key(cmdline.main):
-    error("Missing required function declaration: `{0}'".format(cmdline.main))
+  if cmdline.main not in functions:
+    error(f"Missing required function declaration: `{cmdline.main}'")
 
   # serialize expression
-  expr = functions[cmdline.main][1]
+  expr = functions[cmdline.main][2]
   debug_print("expr", expr)
-  expr_s = "(" + serialize_expression(expr, cmdline.allow_const) + ")"
+  expr = peephole(expr)
 
   # output expression
   if cmdline.dest is None:
-    print(expr_s)
+    write_expression(sys.stdout, expr, cmdline.allow_const)
+    sys.stdout.write("\n")
   else:
+    # validate before opening: open("w") truncates, and a failed compile
+    # must not destroy a previously good output file
+    if not cmdline.allow_const:
+      check_consts(expr)
     # open output file
     outfile = open(cmdline.dest, "w")
-    outfile.write(expr_s + os.linesep)
+    write_expression(outfile, expr, cmdline.allow_const)
+    outfile.write(os.linesep)
     outfile.close()
 
 if __name__ == "__main__":